@@ -0,0 +1,428 @@
+"""
+Benchmarks for pyQBXML.
+
+Usage: python pyQBXMLBench.py [benchmark ...]
+
+Run without arguments to run every benchmark.  The end-to-end benchmarks (put, customers, invoices,
+concurrency and companies) run against a local QBSimulator, with a few milliseconds of latency injected
+per request.
+"""
+import sys
+import time
+import shutil
+import tempfile
+import datetime
+from decimal import Decimal
+
+from lxml import etree
+
+from pyQBXML import QBCustomer, QBAddress, QBInvoice, QBInvoices, QBCustomers, QBSyncStore, AsyncQBOE, QBMetrics
+from pyQBXML import QBReconciler, QBCompanyManager
+from pyQBXML import qbxmlDatetime, qbxmlDecimal, QB_FIXED_SCALE
+from pyQBXMLSim import QBSimulator
+
+class DictRecord(object):
+    """
+    A plain __dict__-based object, used to compare against the slot-based record classes.
+    """
+    pass
+
+def asDictRecord(record):
+    """
+    Copy the attributes of a slot-based record (and any records it refers to) into DictRecords, giving
+    the layout that the record classes had before they used __slots__.
+    """
+    copy = DictRecord()
+    for cls in type(record).__mro__:
+        for attr in cls.__dict__.get('__slots__', ()):
+            value = getattr(record, attr, None)
+            if hasattr(type(value), '__slots__') and not isinstance(value, Decimal):
+                value = asDictRecord(value)
+            setattr(copy, attr.lstrip('_'), value)
+    return copy
+
+def deepSize(objs):
+    """
+    Return the total number of bytes used by objs and everything they refer to.  Objects shared between
+    records (e.g. EMPTY_ADDRESS) are only counted once.
+    """
+    seen = set()
+    total = 0
+    stack = list(objs)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for attr in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, attr):
+                    stack.append(getattr(obj, attr))
+    return total
+
+def makeCustomer(i):
+    c = QBCustomer(list_id="%d-1234567890" % i, name="Customer %d" % i)
+    c.full_name = c.name
+    c.time_created = datetime.datetime(2010, 1, 1, 10, 11, 12)
+    c.time_modified = datetime.datetime(2010, 2, 1, 10, 11, 12)
+    c.edit_sequence = "1234567890"
+    c.sublevel = "0"
+    c.phone = "555-0100"
+    c.email = "customer%d@example.com" % i
+    c.balance = Decimal("%d.50" % i)
+    c.total_balance = c.balance
+    if i % 2:
+        c.bill_address = QBAddress()
+        c.bill_address.address1 = "%d Main St" % i
+        c.bill_address.city = "Springfield"
+        c.bill_address.state = "CA"
+        c.bill_address.postal_code = "90210"
+    return c
+
+def makeInvoice(i):
+    invoice = QBInvoice(invoice_date=datetime.date(2010, 1, 15), customer_id="%d-1234567890" % i, request_id="r%d" % i)
+    invoice.txn_id = "T%d" % i
+    invoice.ref_number = "%d" % i
+    invoice.addLineItem(qty=Decimal("2"), fullname="Rocket sled", description="Rocket-powered sled", rate=Decimal("800.00"))
+    return invoice
+
+def benchRecordMemory(count=50000):
+    """
+    Compare the memory used per record by the slot-based record classes with their __dict__-based layout.
+    Half of the customers have no billing address and so share EMPTY_ADDRESS.
+    """
+    for name, make, collection in (("customer", makeCustomer, QBCustomers), ("invoice", makeInvoice, QBInvoices)):
+        records = collection([make(i) for i in xrange(count)])
+        slotted = deepSize(records.records)
+        plain = deepSize([asDictRecord(r) for r in records])
+        print "%-8s  %8d records  __dict__: %6.0f bytes/record  __slots__: %6.0f bytes/record  (%.0f%% smaller)" \
+                % (name, count, float(plain) / count, float(slotted) / count, 100.0 * (plain - slotted) / plain)
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def benchSerialize(count=10000, lines=5):
+    """
+    Compare QBInvoice.serialize() (an lxml tree serialized with etree.tostring) with serializeBytes(), and
+    check that both produce the same bytes.
+    """
+    invoices = []
+    for i in xrange(count):
+        invoice = QBInvoice(invoice_date=datetime.date(2010, 1, 15), customer_id="%d-1234567890" % i
+                            ,memo="Invoice #%d <monthly> & more" % i, request_id="r%d" % i)
+        for j in xrange(lines):
+            invoice.addLineItem(qty=j + 1, fullname="Item %d" % j, description="Line %d of invoice %d" % (j, i), rate=12.5 * j)
+        invoices.append(invoice)
+
+    lxml_time, lxml_out = timed(lambda: [etree.tostring(inv.serialize(), encoding="utf-8") for inv in invoices])
+    bytes_time, bytes_out = timed(lambda: [inv.serializeBytes() for inv in invoices])
+    assert lxml_out == bytes_out, "serializeBytes() output differs from serialize()"
+    print "%d invoices x %d lines  lxml: %.3fs  bytes: %.3fs  (%.1fx faster)" \
+            % (count, lines, lxml_time, bytes_time, lxml_time / bytes_time)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def simulate(**kwargs):
+    return QBSimulator(**kwargs).start()
+
+def benchPutInvoices(batch_sizes=(10, 100, 1000), workers=(1, 4), latency=0.005, rounds=3):
+    """
+    Measure putInvoices() throughput for different batch sizes, with the batch submitted as a single
+    document or split into chunks of 100 invoices sent on several threads.
+    """
+    sim = simulate(customers=10, latency=latency)
+    try:
+        for batch_size in batch_sizes:
+            for submit_workers in workers:
+                qb = sim.makeClient(sync_store=QBSyncStore(), chunk_size=100, submit_workers=submit_workers)
+                latencies = []
+                for r in xrange(rounds):
+                    invoices = [makeInvoice(i) for i in xrange(batch_size)]
+                    for invoice in invoices:
+                        invoice.customer_id = "1-1000000000"
+                        invoice.line_items.records[0].fullname = "Sled"
+                    elapsed, refs = timed(qb.putInvoices, invoices)
+                    assert len(refs) == batch_size
+                    latencies.append(elapsed)
+                qb.close()
+                print "batch %5d  workers %2d  %8.0f invoices/s  p50 %.3fs  max %.3fs" \
+                        % (batch_size, submit_workers, batch_size * rounds / sum(latencies)
+                            ,percentile(latencies, 50), max(latencies))
+    finally:
+        sim.stop()
+
+def benchQuery(name, method, counts, page_sizes, latency, rounds):
+    for count in counts:
+        kwargs = {name: count}
+        if name == 'invoices':
+            kwargs['customers'] = 10
+        sim = simulate(latency=latency, **kwargs)
+        try:
+            for page_size in page_sizes:
+                qb = sim.makeClient(sync_store=QBSyncStore(), page_size=page_size or count)
+                fetch = getattr(qb, method)
+                latencies = []
+                for r in xrange(rounds):
+                    elapsed, records = timed(lambda: list(fetch()))
+                    assert len(records) == count
+                    latencies.append(elapsed)
+                qb.close()
+                print "%-14s %6d records  page %6s  %8.0f records/s  p50 %.3fs  max %.3fs" \
+                        % (method, count, page_size or "-", count * rounds / sum(latencies)
+                            ,percentile(latencies, 50), max(latencies))
+        finally:
+            sim.stop()
+
+def benchGetCustomers(counts=(100, 1000, 10000), latency=0.005, rounds=3):
+    """
+    Measure getCustomers() (one response) and iterCustomers() (pages of 500) throughput for different
+    numbers of customers.
+    """
+    benchQuery('customers', 'getCustomers', counts, (None,), latency, rounds)
+    benchQuery('customers', 'iterCustomers', counts, (500,), latency, rounds)
+
+def benchGetInvoices(counts=(100, 1000, 10000), latency=0.005, rounds=3):
+    """
+    Measure getInvoices() and iterInvoices() throughput for different numbers of invoices.
+    """
+    benchQuery('invoices', 'getInvoices', counts, (None,), latency, rounds)
+    benchQuery('invoices', 'iterInvoices', counts, (500,), latency, rounds)
+
+def benchConcurrency(levels=(1, 4, 16), requests=64, customers=100, latency=0.02):
+    """
+    Measure request throughput and latency through AsyncQBOE at different levels of concurrency, with a
+    gateway that takes latency seconds per request.
+    """
+    sim = simulate(customers=customers, latency=latency)
+    try:
+        for workers in levels:
+            qb = sim.makeClient(cls=AsyncQBOE, sync_store=QBSyncStore(), workers=workers, pool_size=workers)
+            qb.getCustomers().result()
+            latencies = []
+
+            def fetch():
+                start = time.time()
+                qb.client.getCustomers()
+                latencies.append(time.time() - start)
+
+            start = time.time()
+            futures = [qb.executor.submit(fetch) for i in xrange(requests)]
+            for f in futures:
+                f.result()
+            elapsed = time.time() - start
+            qb.close()
+            print "workers %2d  %7.1f requests/s  p50 %.3fs  p95 %.3fs" \
+                    % (workers, requests / elapsed, percentile(latencies, 50), percentile(latencies, 95))
+    finally:
+        sim.stop()
+
+def benchCompanies(batches=8, batch_size=25, rounds=3, latency=0.005):
+    """
+    Post invoices for two companies (weights 2 and 1) at once through a QBCompanyManager, then reconcile
+    each incrementally, checking that each company's sync state only ever holds its own invoices.
+    """
+    sim = simulate(customers=10, latency=latency)
+    sync_dir = tempfile.mkdtemp(prefix="qbbench")
+    manager = QBCompanyManager(sim.api_url, sim.keyfile, sim.certfile, "qbsim", "1", "1", workers=3, max_concurrency=3
+                                ,ssl_context=sim.clientContext(), sync_store=sync_dir)
+    try:
+        weights = {"acme": 2, "globex": 1}
+        for name, weight in weights.iteritems():
+            manager.addCompany(name, "TGT-%s" % name, weight=weight)
+        posted = dict((name, []) for name in weights)
+        ref_numbers = dict((name, {}) for name in weights)
+        for r in xrange(rounds):
+            # Let each round's invoices get a later TimeModified (the gateway's resolution is a second) than
+            # the previous round's, so the incremental syncs only download the new ones.
+            time.sleep(1)
+            futures = []
+            finished = {}
+            start = time.time()
+            for b in xrange(batches):
+                for name in weights:
+                    invoices = []
+                    for i in xrange(batch_size):
+                        invoice = makeInvoice((r * batches + b) * batch_size + i)
+                        invoice.customer_id = "1-1000000000"
+                        invoice.ref_number = invoice.txn_id = None
+                        invoice.memo = name
+                        invoice.line_items.records[0].fullname = "Sled"
+                        invoices.append(invoice)
+                    posted[name].extend(invoices)
+                    future = manager.submit(name, "putInvoices", invoices)
+                    future.addDoneCallback(lambda f, name=name: finished.__setitem__(name, time.time() - start))
+                    futures.append((name, future))
+            for name, future in futures:
+                ref_numbers[name].update(future.result())
+
+            reports = dict((name, manager.submit(name, "reconcileInvoices", posted[name], ref_numbers=ref_numbers[name]))
+                            for name in weights)
+            for name, future in reports.iteritems():
+                report = future.result()
+                # The simulated companies number their invoices alike, so check the memos too.
+                assert len(report.matched) == len(posted[name]) and not report.missing and not report.extra \
+                        and all(remote.memo == name for local, remote in report.matched), "%s: %r" % (name, report)
+            print "round %d  %s" % (r + 1, "  ".join("%s (weight %d) %5.0f invoices/s"
+                                                    % (name, weights[name], batches * batch_size / finished[name])
+                                                    for name in sorted(weights)))
+    finally:
+        manager.close()
+        sim.stop()
+        shutil.rmtree(sync_dir, ignore_errors=True)
+
+def benchMetrics(count=5000, page_size=100, rounds=5):
+    """
+    Compare iterCustomers() with metrics disabled and with QBMetrics collecting a trace per page.
+    """
+    sim = simulate(customers=count)
+    try:
+        for label, metrics in (("disabled", None), ("QBMetrics", QBMetrics())):
+            qb = sim.makeClient(sync_store=QBSyncStore(), page_size=page_size, metrics=metrics)
+            list(qb.iterCustomers())
+            elapsed = min(timed(lambda: list(qb.iterCustomers()))[0] for r in xrange(rounds))
+            qb.close()
+            print "metrics %-10s %6d records in pages of %d  best %.3fs" % (label, count, page_size, elapsed)
+    finally:
+        sim.stop()
+
+def benchProjection(count=10000, rounds=3):
+    """
+    Compare fetching every customer field with fetching only Balance (plus the ListID and Name that are
+    always included), as a balance check would.
+    """
+    sim = simulate(customers=count)
+    try:
+        qb = sim.makeClient(sync_store=QBSyncStore(), metrics=QBMetrics())
+        for label, fields in (("all fields", None), ("Balance only", ['Balance'])):
+            received = qb.metrics.bytes_received
+            elapsed = min(timed(lambda: qb.getCustomers(fields=fields))[0] for r in xrange(rounds))
+            print "%-14s %6d customers  best %.3fs  %8.0f bytes/customer" \
+                    % (label, count, elapsed, float(qb.metrics.bytes_received - received) / (count * rounds))
+        qb.close()
+    finally:
+        sim.stop()
+
+def benchLazy(count=10000, rounds=3):
+    """
+    Compare getInvoices() with eagerly built records and with lazy_records, for a scan that reads only
+    is_paid and for one that reads every field.
+    """
+    sim = simulate(customers=100, invoices=count)
+    try:
+        for lazy in (False, True):
+            qb = sim.makeClient(sync_store=QBSyncStore(), lazy_records=lazy)
+            for label, scan in (("is_paid only", lambda invoices: [i.is_paid for i in invoices])
+                                ,("every field", lambda invoices: [(i.is_paid, i.invoice_date, i.time_modified
+                                                                    ,len(i.line_items)) for i in invoices])):
+                elapsed = min(timed(lambda: scan(qb.getInvoices()))[0] for r in xrange(rounds))
+                print "%-6s %-14s %6d invoices  best %.3fs" % ("lazy" if lazy else "eager", label, count, elapsed)
+            qb.close()
+    finally:
+        sim.stop()
+
+def benchCodecs(count=100000, distinct=(1, 1000, 100000)):
+    """
+    Compare the speed of the qbXML value decoders with the strptime and Decimal conversions they replace,
+    for inputs with different numbers of distinct values (which decides how much the memo helps).  Their
+    correctness is checked by test_pyQBXML.
+    """
+    for n in distinct:
+        stamps = ["2010-%02d-%02dT%02d:%02d:%02d-08:00" % (i % 12 + 1, i % 28 + 1, i % 24, i % 60, (i // 60) % 60)
+                    for i in xrange(n)] * (count // n)
+        amounts = ["%d.%02d" % (i, i % 100) for i in xrange(n)] * (count // n)
+        old_dt = timed(lambda: [datetime.datetime(*time.strptime(s[:19], "%Y-%m-%dT%H:%M:%S")[0:5]) for s in stamps])[0]
+        new_dt = timed(lambda: [qbxmlDatetime(s) for s in stamps])[0]
+        old_dec = timed(lambda: [Decimal(a) for a in amounts])[0]
+        new_dec = timed(lambda: [qbxmlDecimal(a) for a in amounts])[0]
+        print "%6d distinct  datetime: strptime %.3fs  codec %.3fs (%.1fx)  decimal: Decimal %.3fs  codec %.3fs (%.1fx)" \
+                % (n, old_dt, new_dt, old_dt / new_dt, old_dec, new_dec, old_dec / new_dec)
+
+def benchExport(count=10000, rounds=3):
+    """
+    Compare building per-customer totals from getInvoices() records with exportInvoices() and its
+    columnar totalsByCustomer().
+    """
+    sim = simulate(customers=100, invoices=count)
+    try:
+        qb = sim.makeClient(sync_store=QBSyncStore())
+
+        def fromRecords():
+            totals = {}
+            for invoice in qb.getInvoices():
+                for li in invoice.line_items:
+                    totals[invoice.customer_id] = totals.get(invoice.customer_id, 0) + li.qty * li.rate
+            return totals
+
+        def fromColumns():
+            return qb.exportInvoices().totalsByCustomer()
+
+        records_time, expected = min(timed(fromRecords) for r in xrange(rounds))
+        columns_time, totals = min(timed(fromColumns) for r in xrange(rounds))
+        assert dict((k, Decimal(v) / QB_FIXED_SCALE) for k, v in totals.iteritems()) == expected
+        print "%d invoices  records: %.3fs  columns: %.3fs  (%.1fx faster)" \
+                % (count, records_time, columns_time, records_time / columns_time)
+        qb.close()
+    finally:
+        sim.stop()
+
+def benchReconcile(counts=(10000, 100000, 200000)):
+    """
+    Measure QBReconciler on local and remote sets of the same size, to check that its time grows linearly.
+    A third of the local invoices are matched by RefNumber (half of them by their own ref_number and half
+    through the ref_numbers map), a third by content and the rest are missing.
+    """
+    for count in counts:
+        local = [makeInvoice(i) for i in xrange(count)]
+        remote = []
+        ref_numbers = {}
+        for i, invoice in enumerate(local):
+            invoice.ref_number = None
+            if i % 3 == 2:
+                remote.append(makeInvoice(count + i))
+                continue
+            copy = makeInvoice(i)
+            copy.ref_number = "R%d" % i
+            remote.append(copy)
+            if i % 6 == 0:
+                invoice.ref_number = copy.ref_number
+            elif i % 6 == 3:
+                ref_numbers[invoice.request_id] = copy.ref_number
+        elapsed, report = timed(QBReconciler(remote).reconcile, local, ref_numbers)
+        missing = count // 3
+        assert len(report.matched) == count - missing and len(report.missing) == missing
+        assert not report.differs and len(report.extra) == missing
+        print "%7d invoices  %.3fs  %.1f us/invoice  %r" % (count, elapsed, 1e6 * elapsed / count, report)
+
+BENCHMARKS = {
+    'memory': benchRecordMemory,
+    'serialize': benchSerialize,
+    'put': benchPutInvoices,
+    'customers': benchGetCustomers,
+    'invoices': benchGetInvoices,
+    'concurrency': benchConcurrency,
+    'companies': benchCompanies,
+    'metrics': benchMetrics,
+    'projection': benchProjection,
+    'lazy': benchLazy,
+    'codecs': benchCodecs,
+    'export': benchExport,
+    'reconcile': benchReconcile,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print "== %s" % name
+        BENCHMARKS[name]()
@@ -0,0 +1,517 @@
+"""
+A local stand-in for the QBOE gateway, for testing and benchmarking pyQBXML without a Quickbooks account.
+
+Usage: python pyQBXMLSim.py [port]
+
+The simulator speaks qbXML over HTTPS (with keep-alive and chunked request bodies) and implements
+sign-on, CustomerQueryRq, InvoiceQueryRq, ItemQueryRq (with iterators, the common filters,
+IncludeLineItems and IncludeRetElement), InvoiceAddRq (including status 3140 for line items that refer
+to missing items, and 3175 for invoices of a locked customer) and ItemServiceAddRq.  Like Quickbooks,
+InvoiceQueryRq leaves out the invoice lines unless IncludeLineItems is true.  Latency, throttling and
+failed or lost responses can be injected to see how a client behaves against a slow, overloaded or
+unreliable gateway.
+Each connection ticket signs on to its own company file, so clients for different companies don't see
+each other's records.
+
+Unless a certificate and key are given, a self-signed pair for "localhost" is generated with the
+openssl command line tool.  The same pair can be used as the client certificate:
+
+    sim = QBSimulator(customers=1000).start()
+    qb = sim.makeClient()
+    print len(qb.getCustomers())
+    sim.stop()
+"""
+import sys
+import os
+import time
+import random
+import shutil
+import socket
+import ssl
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+from lxml import etree
+
+from pyQBXML import QBOE, qbxmlText, qbxmlAttr
+
+def utcOffset(seconds_west):
+    return "%s%02d:%02d" % ("-" if seconds_west > 0 else "+", abs(seconds_west) // 3600, abs(seconds_west) // 60 % 60)
+
+# Timestamps are the local time with its UTC offset, as the gateway sends them.  Modified date filters
+# compare only the date and time, so they are taken to be in the same offset.
+SIM_EPOCH = "2010-01-01T00:00:00" + utcOffset(time.timezone)
+
+DEFAULT_CONN_TICKET = "TGT-1-simulator"
+
+def simNow():
+    now = time.localtime()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", now) + utcOffset(time.altzone if now.tm_isdst > 0 else time.timezone)
+
+class QBSimHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response and send it in one write (handle_one_request flushes it); unbuffered, the status
+    # line, every header and the body go out as separate small segments.
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        if self.server.sim.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Don't let Nagle's algorithm hold back the end of a response until the client's delayed ACK.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.sim._count('connections')
+
+    def __readBody(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return "".join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def __reply(self, status, body="", headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-qbxml')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        sim = self.server.sim
+        body = self.__readBody()
+        sim._count('requests')
+
+        retry_after = sim._throttle()
+        if retry_after is not None:
+            sim._count('throttled')
+            self.__reply(503, headers=[('Retry-After', "%d" % max(1, retry_after))])
+            return
+
+        sim._delay()
+        try:
+            doc = etree.XML(body)
+        except etree.XMLSyntaxError:
+            self.__reply(400)
+            return
+
+        fault = sim._fault(doc)
+        if fault == "drop":
+            # The request is carried out but the connection is closed before the response is sent.
+            sim.handle(doc)
+            self.close_connection = 1
+        elif fault == "close":
+            # The response is sent, but the connection is closed afterwards without saying so.
+            self.__reply(200, sim.handle(doc))
+            self.close_connection = 1
+        elif fault is not None:
+            self.__reply(fault)
+        else:
+            self.__reply(200, sim.handle(doc))
+
+class QBSimServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Enough for a benchmark's worth of clients connecting at once; with the default of 5, the kernel
+    # drops the extra SYNs and those connections stall for a second before retrying.
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients closing keep-alive connections show up here; they aren't worth a traceback.
+        if self.sim.verbose:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class QBSimCompany(object):
+    """
+    The records of one simulated company file: customers and invoices as (TimeModified, Ret XML) pairs, and
+    service items by lower-cased name.  locked maps a customer's ListID to the number of invoices for it
+    still to be refused with status 3175, as if another user were editing the customer.
+    """
+    def __init__(self, customers=100, invoices=0, items=("Sled",)):
+        self.customers = [(SIM_EPOCH, self.__customerRet(i)) for i in xrange(customers)]
+        self.invoices = []
+        self.items = {}
+        self.locked = {}
+        for name in items:
+            self.addItem(name, SIM_EPOCH)
+        for i in xrange(invoices):
+            self.addInvoice(self.__sampleInvoice(i))
+
+    def __customerRet(self, i):
+        return ("<CustomerRet><ListID>%d-1000000000</ListID><TimeCreated>%s</TimeCreated><TimeModified>%s</TimeModified>"
+                "<EditSequence>1000000000</EditSequence><Name>Customer %d</Name><FullName>Customer %d</FullName>"
+                "<IsActive>true</IsActive><Sublevel>0</Sublevel><CompanyName>Company %d</CompanyName>"
+                "<BillAddress><Addr1>%d Main St</Addr1><City>Springfield</City><State>CA</State>"
+                "<PostalCode>%05d</PostalCode></BillAddress><Phone>555-0100</Phone><Email>customer%d@example.com</Email>"
+                "<Balance>%d.50</Balance><TotalBalance>%d.50</TotalBalance><DeliveryMethod>Email</DeliveryMethod>"
+                "</CustomerRet>" % (i, SIM_EPOCH, SIM_EPOCH, i, i, i, i, i % 100000, i, i, i))
+
+    def __sampleInvoice(self, i):
+        add = etree.Element("InvoiceAdd")
+        etree.SubElement(etree.SubElement(add, "CustomerRef"), "ListID").text = "%d-1000000000" % (i % max(1, len(self.customers)))
+        etree.SubElement(add, "TxnDate").text = "2010-01-15"
+        line = etree.SubElement(add, "InvoiceLineAdd")
+        etree.SubElement(etree.SubElement(line, "ItemRef"), "FullName").text = min(self.items.itervalues())[0]
+        etree.SubElement(line, "Desc").text = "Line 1"
+        etree.SubElement(line, "Quantity").text = "2"
+        etree.SubElement(line, "Rate").text = "800.00"
+        return add
+
+    def addItem(self, name, modified=None):
+        list_id = "%d-2000000000" % (len(self.items) + 1)
+        modified = modified or simNow()
+        self.items[name.lower()] = (name, list_id, modified)
+        return list_id, modified
+
+    def addInvoice(self, add):
+        """
+        Store an invoice from an InvoiceAdd element and return its InvoiceRet.
+        """
+        txn_number = len(self.invoices) + 1
+        now = simNow()
+        customer_id = add.findtext("CustomerRef/ListID") or ""
+        parts = ["<InvoiceRet><TxnID>%d-3000000000</TxnID><TimeCreated>%s</TimeCreated><TimeModified>%s</TimeModified>"
+                "<EditSequence>1</EditSequence><TxnNumber>%d</TxnNumber><CustomerRef><ListID>%s</ListID></CustomerRef>"
+                "<TxnDate>%s</TxnDate><RefNumber>%d</RefNumber>"
+                % (txn_number, now, now, txn_number, qbxmlText(customer_id), qbxmlText(add.findtext("TxnDate") or "")
+                    ,1000 + txn_number)]
+        if add.findtext("Memo"):
+            parts.append("<Memo>%s</Memo>" % qbxmlText(add.findtext("Memo")))
+        parts.append("<IsPaid>false</IsPaid>")
+        for n, line in enumerate(add.iterfind("InvoiceLineAdd")):
+            parts.append("<InvoiceLineRet><TxnLineID>%d-%d</TxnLineID><ItemRef><FullName>%s</FullName></ItemRef>"
+                        % (txn_number, n, qbxmlText(line.findtext("ItemRef/FullName") or "")))
+            for tag in ("Desc", "Quantity", "Rate"):
+                if line.find(tag) is not None:
+                    parts.append("<%s>%s</%s>" % (tag, qbxmlText(line.findtext(tag) or ""), tag))
+            parts.append("</InvoiceLineRet>")
+        parts.append("</InvoiceRet>")
+        ret = "".join(parts)
+        self.invoices.append((now, ret))
+        return "<InvoiceRet><TxnID>%d-3000000000</TxnID><RefNumber>%d</RefNumber></InvoiceRet>" % (txn_number, 1000 + txn_number)
+
+class QBSimulator(object):
+    """
+    An in-process QBOE gateway.  customers, invoices and items set the initial data of each company file
+    (see company()); latency (plus up to jitter) seconds are added to every response; max_rate limits
+    requests per second, answering any beyond it with 503 and a Retry-After header.  Session tickets
+    expire after ticket_lifetime seconds.  Failures can also be injected one request at a time with
+    inject().
+    """
+    def __init__(self, port=0, certfile=None, keyfile=None, customers=100, invoices=0, items=("Sled",)
+                    ,latency=0.0, jitter=0.0, max_rate=None, ticket_lifetime=3600, verbose=False):
+        self.port = port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.latency = latency
+        self.jitter = jitter
+        self.max_rate = max_rate
+        self.ticket_lifetime = ticket_lifetime
+        self.verbose = verbose
+
+        self.stats = dict.fromkeys(('connections', 'requests', 'throttled', 'faults', 'signons', 'messages'), 0)
+        self.tickets = {}
+        self.iterators = {}
+        self.__data = (customers, invoices, items)
+        self.companies = {}
+        self.company(DEFAULT_CONN_TICKET)
+
+        self.__lock = threading.Lock()
+        self.__window = (0, 0)
+        self.__faults = []
+        self.__tmpdir = None
+        self.__server = None
+
+    def start(self):
+        if self.certfile is None:
+            self.__tmpdir = tempfile.mkdtemp(prefix="qbsim")
+            self.certfile = os.path.join(self.__tmpdir, "cert.pem")
+            self.keyfile = os.path.join(self.__tmpdir, "key.pem")
+            subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "3650"
+                                    ,"-subj", "/CN=localhost", "-keyout", self.keyfile, "-out", self.certfile]
+                                    ,stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+
+        self.__server = QBSimServer(('127.0.0.1', self.port), QBSimHandler)
+        self.__server.sim = self
+        self.__server.socket = ssl.wrap_socket(self.__server.socket, certfile=self.certfile, keyfile=self.keyfile
+                                                ,server_side=True)
+        self.port = self.__server.server_address[1]
+
+        t = threading.Thread(target=self.__server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+        if self.__tmpdir is not None:
+            shutil.rmtree(self.__tmpdir, ignore_errors=True)
+            self.__tmpdir = None
+
+    @property
+    def api_url(self):
+        return "localhost:%d/j/AppGateway" % self.port
+
+    def clientContext(self):
+        """
+        Return an SSLContext that trusts the simulator's certificate.
+        """
+        return ssl.create_default_context(cafile=self.certfile)
+
+    def makeClient(self, cls=QBOE, **kwargs):
+        """
+        Return a QBOE (or cls) instance connected to the simulator.  kwargs override the defaults.
+        """
+        options = dict(api_url=self.api_url, key_file=self.keyfile, cert_file=self.certfile, app_name="qbsim"
+                        ,app_id="1", app_ver="1", conn_ticket=DEFAULT_CONN_TICKET, ssl_context=self.clientContext())
+        options.update(kwargs)
+        return cls(**options)
+
+    def company(self, conn_ticket):
+        """
+        Return the QBSimCompany that conn_ticket signs on to, creating it with the initial data if need be.
+        """
+        company = self.companies.get(conn_ticket)
+        if company is None:
+            company = self.companies[conn_ticket] = QBSimCompany(*self.__data)
+        return company
+
+    def inject(self, *faults):
+        """
+        Make the next requests that carry messages (sign-on requests aren't affected) fail, one fault per
+        request: an HTTP status such as 500 or 503 is answered without carrying out the request, "drop"
+        carries it out but closes the connection without answering, as if the response had been lost, and
+        "close" answers but then closes the connection, as a gateway does to an idle keep-alive connection.
+        """
+        with self.__lock:
+            self.__faults.extend(faults)
+
+    def _fault(self, doc):
+        """
+        Return the injected fault for a request, or None.
+        """
+        if doc.find("QBXMLMsgsRq") is None:
+            return None
+        with self.__lock:
+            if not self.__faults:
+                return None
+            self.stats['faults'] += 1
+            return self.__faults.pop(0)
+
+    def _count(self, stat, n=1):
+        with self.__lock:
+            self.stats[stat] += n
+
+    def _throttle(self):
+        """
+        Return the number of seconds the client should wait if the request exceeds max_rate, else None.
+        """
+        if not self.max_rate:
+            return None
+        now = int(time.time())
+        with self.__lock:
+            second, count = self.__window
+            if second != now:
+                second, count = now, 0
+            count += 1
+            self.__window = (second, count)
+        if count > self.max_rate:
+            return 1
+        return None
+
+    def _delay(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, doc):
+        """
+        Process a qbXML request document and return the response document.
+        """
+        out = ['<?xml version="1.0" ?><QBXML><SignonMsgsRs>']
+        signed_on = False
+        with self.__lock:
+            if doc.find("SignonMsgsRq/SignonAppCertRq") is not None:
+                self.stats['signons'] += 1
+                ticket = "V1-%d-%08x" % (self.stats['signons'], random.getrandbits(32))
+                company = self.company(doc.findtext("SignonMsgsRq/SignonAppCertRq/ConnectionTicket") or "")
+                self.tickets[ticket] = (time.time(), company)
+                out.append('<SignonAppCertRs statusCode="0" statusSeverity="INFO"><ServerDateTime>%s</ServerDateTime>'
+                            '<SessionTicket>%s</SessionTicket></SignonAppCertRs>' % (simNow(), ticket))
+            else:
+                ticket = doc.findtext("SignonMsgsRq/SignonTicketRq/SessionTicket")
+                issued, company = self.tickets.get(ticket, (None, None))
+                if issued is None or time.time() - issued > self.ticket_lifetime:
+                    out.append('<SignonTicketRs statusCode="2020" statusSeverity="ERROR"'
+                                ' statusMessage="The session ticket is invalid or has expired."/>')
+                else:
+                    signed_on = True
+                    out.append('<SignonTicketRs statusCode="0" statusSeverity="INFO"/>')
+        out.append('</SignonMsgsRs>')
+
+        msgs = doc.find("QBXMLMsgsRq")
+        if signed_on and msgs is not None:
+            out.append('<QBXMLMsgsRs>')
+            for rq in msgs:
+                self._count('messages')
+                handler = getattr(self, "_rq" + rq.tag, None)
+                if handler is None:
+                    out.append(self.__status(rq, rq.tag[:-2] + "Rs", 3250, "Error", "This feature is not enabled or not available."))
+                else:
+                    with self.__lock:
+                        out.append(handler(company, rq))
+            out.append('</QBXMLMsgsRs>')
+        out.append('</QBXML>')
+        return "".join(out)
+
+    def __status(self, rq, rs_tag, code, severity, message, body="", extra=""):
+        return '<%s requestID="%s" statusCode="%d" statusSeverity="%s" statusMessage="%s"%s>%s</%s>' \
+                % (rs_tag, qbxmlAttr(rq.get("requestID", "")), code, severity, qbxmlAttr(message), extra, body, rs_tag)
+
+    def __filter(self, rq, records):
+        """
+        Apply the filters of a query that need to look inside each record: ListID, FullName, TxnID and
+        RefNumber lists, ActiveStatus, TxnDateRangeFilter, EntityFilter and PaidStatus, and trim each
+        record to its IncludeRetElement fields.  Invoice lines are left out unless IncludeLineItems is true.
+        """
+        tests = []
+        for tag in ("ListID", "FullName", "TxnID", "RefNumber"):
+            values = set(el.text for el in rq.iterfind(tag))
+            if values:
+                tests.append(lambda ret, tag=tag, values=values: ret.findtext(tag) in values)
+        active = rq.findtext("ActiveStatus")
+        if active in ("ActiveOnly", "InactiveOnly"):
+            tests.append(lambda ret: (ret.findtext("IsActive") == "true") == (active == "ActiveOnly"))
+        from_date = rq.findtext("TxnDateRangeFilter/FromTxnDate")
+        if from_date:
+            tests.append(lambda ret: ret.findtext("TxnDate") >= from_date)
+        to_date = rq.findtext("TxnDateRangeFilter/ToTxnDate")
+        if to_date:
+            tests.append(lambda ret: ret.findtext("TxnDate") <= to_date)
+        customers = set(el.text for el in rq.iterfind("EntityFilter/ListID"))
+        if customers:
+            tests.append(lambda ret: ret.findtext("CustomerRef/ListID") in customers)
+        paid = rq.findtext("PaidStatus")
+        if paid in ("PaidOnly", "NotPaidOnly"):
+            tests.append(lambda ret: (ret.findtext("IsPaid") == "true") == (paid == "PaidOnly"))
+        include = set(el.text for el in rq.iterfind("IncludeRetElement"))
+        exclude = set()
+        if rq.tag == "InvoiceQueryRq" and rq.findtext("IncludeLineItems") != "true":
+            exclude.add("InvoiceLineRet")
+        if not tests and not include and not exclude:
+            return records
+
+        filtered = []
+        for modified, xml in records:
+            ret = etree.fromstring(xml)
+            if all(test(ret) for test in tests):
+                if include or exclude:
+                    for child in list(ret):
+                        if (include and child.tag not in include) or child.tag in exclude:
+                            ret.remove(child)
+                    xml = etree.tostring(ret)
+                filtered.append((modified, xml))
+        return filtered
+
+    def __query(self, rq, rs_tag, records):
+        """
+        Answer a query over records, a list of (TimeModified, Ret XML) pairs, honouring MaxReturned,
+        iterators, modified date filters and the filters handled by __filter().
+        """
+        from_modified = rq.findtext("FromModifiedDate") or rq.findtext("ModifiedDateRangeFilter/FromModifiedDate")
+        if from_modified:
+            from_modified = from_modified[:19]
+            records = [r for r in records if r[0][:19] >= from_modified]
+        to_modified = rq.findtext("ToModifiedDate") or rq.findtext("ModifiedDateRangeFilter/ToModifiedDate")
+        if to_modified:
+            to_modified = to_modified[:19]
+            records = [r for r in records if r[0][:19] <= to_modified]
+        records = self.__filter(rq, records)
+
+        iterator = rq.get("iterator")
+        start = 0
+        iterator_id = None
+        if iterator == "Continue":
+            iterator_id = rq.get("iteratorID")
+            if iterator_id not in self.iterators:
+                return self.__status(rq, rs_tag, 3170, "Error", "Iterator %s has expired or is invalid." % iterator_id)
+            start = self.iterators[iterator_id]
+        elif iterator == "Start":
+            iterator_id = "{%08x-%04x}" % (random.getrandbits(32), len(self.iterators))
+
+        max_returned = rq.findtext("MaxReturned")
+        end = len(records) if max_returned is None else min(len(records), start + int(max_returned))
+        page = records[start:end]
+
+        extra = ""
+        if iterator_id:
+            self.iterators[iterator_id] = end
+            extra = ' iteratorRemainingCount="%d" iteratorID="%s"' % (len(records) - end, iterator_id)
+        if not page:
+            return self.__status(rq, rs_tag, 1, "Info", "A query request did not find a matching object in QuickBooks", extra=extra)
+        return self.__status(rq, rs_tag, 0, "Info", "Status OK", "".join(r[1] for r in page), extra)
+
+    def _rqCustomerQueryRq(self, company, rq):
+        return self.__query(rq, "CustomerQueryRs", company.customers)
+
+    def _rqInvoiceQueryRq(self, company, rq):
+        return self.__query(rq, "InvoiceQueryRs", company.invoices)
+
+    def _rqItemQueryRq(self, company, rq):
+        items = [(modified, "<ItemServiceRet><ListID>%s</ListID><TimeModified>%s</TimeModified><Name>%s</Name>"
+                    "<FullName>%s</FullName><IsActive>true</IsActive></ItemServiceRet>"
+                    % (list_id, modified, qbxmlText(name), qbxmlText(name)))
+                for name, list_id, modified in sorted(company.items.itervalues())]
+        return self.__query(rq, "ItemQueryRs", items)
+
+    def _rqInvoiceAddRq(self, company, rq):
+        add = rq.find("InvoiceAdd")
+        if add is None or not add.findtext("CustomerRef/ListID"):
+            return self.__status(rq, "InvoiceAddRs", 3120, "Error", "Object specified in the request cannot be found.")
+        customer_id = add.findtext("CustomerRef/ListID")
+        if company.locked.get(customer_id):
+            company.locked[customer_id] -= 1
+            return self.__status(rq, "InvoiceAddRs", 3175, "Error"
+                                ,"There was an error when saving a Customers list, element \"%s\". QuickBooks"
+                                " error message: The object is in use by another user." % customer_id)
+        for name in add.iterfind("InvoiceLineAdd/ItemRef/FullName"):
+            if (name.text or "").lower() not in company.items:
+                return self.__status(rq, "InvoiceAddRs", 3140, "Error"
+                                    ,"Invalid reference to ItemList: %s in ItemRef" % (name.text or ""))
+        return self.__status(rq, "InvoiceAddRs", 0, "Info", "Status OK", company.addInvoice(add))
+
+    def _rqItemServiceAddRq(self, company, rq):
+        name = rq.findtext("ItemServiceAdd/Name") or ""
+        if not name:
+            return self.__status(rq, "ItemServiceAddRs", 3070, "Error", "The string in the Name field is too short.")
+        if name.lower() in company.items:
+            return self.__status(rq, "ItemServiceAddRs", 3100, "Error", 'The name "%s" of the list element is already in use.' % name)
+        list_id, modified = company.addItem(name)
+        ret = ("<ItemServiceRet><ListID>%s</ListID><TimeModified>%s</TimeModified><Name>%s</Name><FullName>%s</FullName>"
+                "</ItemServiceRet>" % (list_id, modified, qbxmlText(name), qbxmlText(name)))
+        return self.__status(rq, "ItemServiceAddRs", 0, "Info", "Status OK", ret)
+
+if __name__ == '__main__':
+    sim = QBSimulator(port=int(sys.argv[1]) if len(sys.argv) > 1 else 0).start()
+    print "QBOE simulator listening on https://%s" % sim.api_url
+    print "Client certificate: %s  key: %s" % (sim.certfile, sim.keyfile)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sim.stop()
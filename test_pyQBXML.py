@@ -0,0 +1,1051 @@
+"""
+Unit tests for pyQBXML.
+
+Usage: python -m unittest test_pyQBXML
+"""
+import cPickle
+import datetime
+import httplib
+import os
+import pickle
+import shutil
+import socket
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+from decimal import Decimal
+
+from lxml import etree
+
+import pyQBXML
+from pyQBXML import QBFixedOffset, qbxmlDatetime, qbxmlDate, qbxmlDecimal, qbxmlDatetimeText
+from pyQBXML import qbxmlFixed, qbxmlFixedText, qbxmlFixedProduct, QB_FIXED_SCALE
+from pyQBXML import QBInvoice, QBInvoices, QBResults, qbxmlText, qbxmlAttr
+from pyQBXML import QBOEError, QBOEHTTPError, QBOELookupError, QBXMLError, QBSyncStore, QBSubmitQueue
+from pyQBXML import QBTransportPolicy, QBReconciler, QBRecordCache, QBCompanyManager
+from pyQBXML import QBOECircuitOpenError, QBCircuitBreaker, QBTokenBucket, AsyncQBOE, QBMetrics
+from pyQBXML import QBPrometheusMetrics, QBFileTicketCache, QBItemCatalog, QBItemType
+from pyQBXMLSim import QBSimulator, SIM_EPOCH
+
+class CodecTest(unittest.TestCase):
+    def assertDatetime(self, text, expected):
+        value = qbxmlDatetime(text)
+        self.assertEqual(value, expected)
+        self.assertEqual(value.utcoffset(), expected.utcoffset())
+        self.assertEqual(value.microsecond, expected.microsecond)
+        return value
+
+    def testNaiveDatetime(self):
+        value = self.assertDatetime("2010-01-02T03:04:05", datetime.datetime(2010, 1, 2, 3, 4, 5))
+        self.assertEqual(value.tzinfo, None)
+
+    def testOffsets(self):
+        self.assertDatetime("2010-01-02T03:04:05-08:00", datetime.datetime(2010, 1, 2, 3, 4, 5, 0, QBFixedOffset(-480)))
+        self.assertDatetime("2010-01-02T03:04:05+05:30", datetime.datetime(2010, 1, 2, 3, 4, 5, 0, QBFixedOffset(330)))
+        self.assertEqual(qbxmlDatetime("2010-01-02T03:04:05-08:00").tzinfo.minutes, -480)
+
+    def testZulu(self):
+        value = self.assertDatetime("2010-01-02T03:04:05Z", datetime.datetime(2010, 1, 2, 3, 4, 5, 0, QBFixedOffset(0)))
+        self.assertEqual(value.utcoffset(), datetime.timedelta(0))
+
+    def testFractionalSeconds(self):
+        pst = QBFixedOffset(-480)
+        self.assertDatetime("2010-01-02T03:04:05.25-08:00", datetime.datetime(2010, 1, 2, 3, 4, 5, 250000, pst))
+        self.assertDatetime("2010-01-02T03:04:05.000001", datetime.datetime(2010, 1, 2, 3, 4, 5, 1))
+        # Digits beyond microseconds are dropped.
+        self.assertDatetime("2010-01-02T03:04:05.1234567Z", datetime.datetime(2010, 1, 2, 3, 4, 5, 123456, QBFixedOffset(0)))
+
+    def testInvalidDatetimes(self):
+        for text in ("2010-01-02", "2010-01-02 03:04:05", "2010-01-02T03:04:05-0800", "2010-01-02T03:04:05.Z"
+                    ,"2010-01-02T03:04:05+08"):
+            self.assertRaises(ValueError, qbxmlDatetime, text)
+
+    def testDatetimeText(self):
+        self.assertEqual(qbxmlDatetimeText(qbxmlDatetime("2010-01-02T03:04:05-08:00")), "2010-01-02T03:04:05-08:00")
+        self.assertEqual(qbxmlDatetimeText(qbxmlDatetime("2010-01-02T03:04:05Z")), "2010-01-02T03:04:05+00:00")
+        self.assertEqual(qbxmlDatetimeText(datetime.datetime(1899, 12, 31, 23, 59, 59)), "1899-12-31T23:59:59")
+
+    def testDates(self):
+        self.assertEqual(qbxmlDate("2010-01-15"), datetime.date(2010, 1, 15))
+        self.assertEqual(qbxmlDate("2012-02-29"), datetime.date(2012, 2, 29))
+        for text in ("2010-1-15", "2010-01-15T00:00:00", "2010/01/15"):
+            self.assertRaises(ValueError, qbxmlDate, text)
+        self.assertRaises(ValueError, qbxmlDate, "2011-02-29")
+
+    def testDecimals(self):
+        self.assertEqual(qbxmlDecimal("800.00"), Decimal("800.00"))
+        self.assertEqual(str(qbxmlDecimal("-1.50")), "-1.50")
+
+    def testFixedPoint(self):
+        self.assertEqual(qbxmlFixed("800.00"), 800 * QB_FIXED_SCALE)
+        self.assertEqual(qbxmlFixed("-1.5"), -150000)
+        self.assertEqual(qbxmlFixed(".25"), 25000)
+        self.assertEqual(qbxmlFixed("1.1234567"), 112345)
+        self.assertRaises(ValueError, qbxmlFixed, ".")
+        self.assertEqual(qbxmlFixedText(-150000), "-1.50")
+        self.assertEqual(qbxmlFixedText(112345), "1.12345")
+        self.assertEqual(qbxmlFixedProduct(qbxmlFixed("2"), qbxmlFixed("0.00005")), 10)
+        self.assertEqual(qbxmlFixedProduct(qbxmlFixed("-0.5"), qbxmlFixed("0.00001")), -1)
+
+    def testMemoized(self):
+        for decode, text in ((qbxmlDatetime, "2010-01-02T03:04:05-08:00"), (qbxmlDate, "2010-01-15")
+                            ,(qbxmlDecimal, "12.50")):
+            self.assertTrue(decode(text) is decode(text), text)
+
+    def testMemoBound(self):
+        for i in xrange(pyQBXML.QB_CODEC_MEMO_SIZE + 10):
+            qbxmlDatetime("2010-01-01T00:00:00.%06d" % i)
+            qbxmlDecimal("%d.01" % i)
+            self.assertTrue(len(pyQBXML._datetimes) <= pyQBXML.QB_CODEC_MEMO_SIZE)
+            self.assertTrue(len(pyQBXML._decimals) <= pyQBXML.QB_CODEC_MEMO_SIZE)
+        # Values decoded after the memo was emptied are still correct.
+        self.assertEqual(qbxmlDatetime("2010-01-01T00:00:00.000003"), datetime.datetime(2010, 1, 1, 0, 0, 0, 3))
+
+class SerializeTest(unittest.TestCase):
+    def makeInvoice(self, memo, item="Sled"):
+        invoice = QBInvoice(invoice_date=datetime.date(2010, 1, 15), customer_id="1-1000000000", memo=memo
+                            ,request_id="r1")
+        invoice.addLineItem(qty=Decimal("2"), fullname=item, description="Rocket sled", rate=Decimal("800.00"))
+        return invoice
+
+    def testEscaping(self):
+        self.assertEqual(qbxmlText("a & b <c> \r"), "a &amp; b &lt;c&gt; &#13;")
+        self.assertEqual(qbxmlAttr('"a"\t\n'), "&quot;a&quot;&#9;&#10;")
+        self.assertEqual(qbxmlText(u"caf\xe9"), "caf\xc3\xa9")
+        # Valid characters sharing a UTF-8 lead byte with invalid ones pass through.
+        self.assertEqual(qbxmlText(u"\ud55c \ufffd &"), "\xed\x95\x9c \xef\xbf\xbd &amp;")
+
+    def testInvalidCharacters(self):
+        for text in ("bell \x07", "nul \x00", "\x1f", u"\x0b", unichr(0xd800), unichr(0xfffe), unichr(0xffff)
+                    ,"caf\xc3\xa9", "\xff", "\xed\x95\x9c"):
+            self.assertRaises(ValueError, qbxmlText, text)
+            self.assertRaises(ValueError, qbxmlAttr, text)
+            self.assertRaises(ValueError, self.makeInvoice(text).serializeBytes)
+            self.assertRaises(ValueError, self.makeInvoice(text).serialize)
+            self.assertRaises(ValueError, self.makeInvoice(None, item=text).serializeBytes)
+            self.assertRaises(ValueError, self.makeInvoice(None, item=text).serialize)
+
+    def testMatchesLxml(self):
+        for memo in ("plain", "tab\tnewline\n & <tags>\r", "", None):
+            invoice = self.makeInvoice(memo)
+            self.assertEqual(invoice.serializeBytes(), etree.tostring(invoice.serialize(), encoding="utf-8"))
+
+class SimTestCase(unittest.TestCase):
+    """
+    Runs its tests against one QBSimulator.  Each test signs on with a connection ticket of its own, and
+    so gets a company file of its own (see company()).
+    """
+    sim_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = QBSimulator(**cls.sim_options).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sim.stop()
+
+    def makeClient(self, **kwargs):
+        kwargs.setdefault('conn_ticket', self.id())
+        qb = self.sim.makeClient(**kwargs)
+        self.addCleanup(qb.close)
+        return qb
+
+    def company(self):
+        return self.sim.company(self.id())
+
+    def makeInvoice(self, request_id, customer=0, memo=None, item="Sled"):
+        invoice = QBInvoice(invoice_date=datetime.date(2010, 1, 15), customer_id="%d-1000000000" % customer
+                            ,memo=memo, request_id=request_id)
+        invoice.addLineItem(qty=Decimal("1"), fullname=item, description="Line 1", rate=Decimal("10.00"))
+        return invoice
+
+class SimulatorTest(SimTestCase):
+    sim_options = dict(customers=3, invoices=2)
+
+    def query(self, rq):
+        """
+        Sign on and send rq (qbXML text) straight to the simulator, returning the response element.
+        """
+        signon = etree.XML("<QBXML><SignonMsgsRq><SignonAppCertRq><ConnectionTicket>%s</ConnectionTicket>"
+                            "</SignonAppCertRq></SignonMsgsRq></QBXML>" % self.id())
+        ticket = etree.XML(self.sim.handle(signon)).findtext("SignonMsgsRs/SignonAppCertRs/SessionTicket")
+        doc = etree.XML("<QBXML><SignonMsgsRq><SignonTicketRq><SessionTicket>%s</SessionTicket></SignonTicketRq>"
+                        "</SignonMsgsRq><QBXMLMsgsRq>%s</QBXMLMsgsRq></QBXML>" % (ticket, rq))
+        return etree.XML(self.sim.handle(doc)).find("QBXMLMsgsRs")[0]
+
+    def testLineItemsOnlyWhenAsked(self):
+        rs = self.query("<InvoiceQueryRq/>")
+        self.assertEqual(len(rs.findall("InvoiceRet")), 2)
+        self.assertEqual(rs.findall("InvoiceRet/InvoiceLineRet"), [])
+        rs = self.query("<InvoiceQueryRq><IncludeLineItems>true</IncludeLineItems></InvoiceQueryRq>")
+        self.assertEqual(len(rs.findall("InvoiceRet/InvoiceLineRet")), 2)
+        rs = self.query("<InvoiceQueryRq><IncludeLineItems>true</IncludeLineItems>"
+                        "<IncludeRetElement>TxnID</IncludeRetElement></InvoiceQueryRq>")
+        self.assertEqual([child.tag for child in rs.find("InvoiceRet")], ["TxnID"])
+
+    def testCompaniesAreSeparate(self):
+        qb = self.makeClient()
+        other = self.makeClient(conn_ticket=self.id() + "-other")
+        qb.addInvoice(self.makeInvoice("r1"))
+        qb.putInvoices()
+        self.assertEqual(len(self.company().invoices), 3)
+        self.assertEqual(len(self.sim.company(self.id() + "-other").invoices), 2)
+        self.assertEqual(len(other.getCustomers()), 3)
+
+    def testInjectedFaults(self):
+        qb = self.makeClient(transport_policy=QBTransportPolicy(add_retries=0, failure_threshold=None))
+        qb.getCustomers()
+        self.sim.inject("drop")
+        qb.addInvoice(self.makeInvoice("r1"))
+        self.assertRaises(socket.error, qb.putInvoices)
+        # The invoice was added even though its response was lost.
+        self.assertEqual(len(self.company().invoices), 3)
+        self.sim.inject(500)
+        self.assertRaises(QBOEHTTPError, qb.putInvoices, [self.makeInvoice("r2")])
+        self.assertEqual(len(self.company().invoices), 3)
+
+class SubmitQueueTest(SimTestCase):
+    def makeClient(self, **kwargs):
+        self.queue = QBSubmitQueue()
+        return SimTestCase.makeClient(self, submit_queue=self.queue
+                                        ,transport_policy=QBTransportPolicy(add_retries=0, failure_threshold=None)
+                                        ,**kwargs)
+
+    def testLostResponseIsNotResubmitted(self):
+        qb = self.makeClient()
+        qb.addInvoice(self.makeInvoice("r1"))
+        qb.addInvoice(self.makeInvoice("r2", customer=1))
+        self.sim.inject("drop")
+        self.assertRaises(socket.error, qb.putInvoices)
+        self.assertEqual([e.state for e in self.queue.entries()], [QBSubmitQueue.IN_FLIGHT] * 2)
+
+        self.assertEqual(sorted(qb.reconcileQueue()), ["r1", "r2"])
+        self.assertEqual([e.state for e in self.queue.entries()], [QBSubmitQueue.POSTED] * 2)
+        self.assertEqual(qb.putInvoices(), {})
+        self.assertEqual(len(self.company().invoices), 2)
+
+    def testUnsentInvoiceIsResubmitted(self):
+        qb = self.makeClient()
+        qb.addInvoice(self.makeInvoice("r1"))
+        self.sim.inject(500)
+        self.assertRaises(QBOEHTTPError, qb.putInvoices)
+        self.assertEqual(qb.reconcileQueue(), {})
+        self.assertEqual(self.queue.get("r1").state, QBSubmitQueue.PENDING)
+        self.assertEqual(qb.putInvoices().keys(), ["r1"])
+        self.assertEqual(len(self.company().invoices), 1)
+
+    def testStreamRefused(self):
+        qb = self.makeClient()
+        self.assertRaises(QBOEError, qb.putInvoiceStream, iter([self.makeInvoice("r1")]))
+        self.assertEqual(self.queue.entries(), [])
+        self.assertEqual(len(self.company().invoices), 0)
+
+    def testQueriedInvoicesHaveLines(self):
+        qb = self.makeClient()
+        qb.addInvoice(self.makeInvoice("r1"))
+        ref_number = qb.putInvoices()["r1"]
+        invoice = qb.getInvoicesByRefNumber([ref_number])[ref_number]
+        self.assertEqual([li.fullname for li in invoice.line_items], ["Sled"])
+        self.assertEqual(invoice.contentKey(), self.makeInvoice("r1").contentKey())
+
+class ReconcileTest(SimTestCase):
+    sim_options = dict(customers=5)
+
+    def setUp(self):
+        self.qb = self.makeClient()
+        posted = self.makeInvoice("r1"), self.makeInvoice("r2", customer=1), self.makeInvoice("r3", customer=2)
+        self.ref_numbers = self.qb.putInvoices(posted)
+        self.qb.putInvoices([self.makeInvoice("other", customer=4)])
+        self.local = [self.makeInvoice("r1"), self.makeInvoice("r2", customer=1)
+                        ,self.makeInvoice("r3", customer=2, memo="changed"), self.makeInvoice("r4", customer=3)]
+
+    def assertReport(self, report):
+        self.assertEqual([(l.request_id, r.ref_number) for l, r in report.matched]
+                        ,[("r1", self.ref_numbers["r1"]), ("r2", self.ref_numbers["r2"])])
+        self.assertEqual([(l.request_id, r.ref_number) for l, r in report.differs], [("r3", self.ref_numbers["r3"])])
+        self.assertEqual(QBReconciler.differences(*report.differs[0]), ["memo"])
+        self.assertEqual([i.request_id for i in report.missing], ["r4"])
+        self.assertEqual([r.customer_id for r in report.extra], ["4-1000000000"])
+
+    def testIncremental(self):
+        # r1 is matched by RefNumber, r2 by content and r3 by customer and date.
+        self.assertReport(self.qb.reconcileInvoices(self.local, ref_numbers={"r1": self.ref_numbers["r1"]}))
+        self.assertReport(self.qb.reconcileInvoices(self.local, ref_numbers={"r1": self.ref_numbers["r1"]}))
+
+    def testFull(self):
+        self.assertReport(self.qb.reconcileInvoices(self.local, incremental=False))
+
+    def testRequeue(self):
+        report = self.qb.reconcileInvoices(self.local, requeue=True)
+        self.assertEqual(report.requeued, ["r4"])
+        self.assertEqual([i.request_id for i in self.qb.invoices], ["r4"])
+        self.assertEqual(len(self.company().invoices), 4)
+
+class TransportTest(SimTestCase):
+    sim_options = dict(customers=2)
+
+    def makeClient(self, **policy):
+        policy.setdefault('backoff', 0.01)
+        policy.setdefault('failure_threshold', None)
+        qb = SimTestCase.makeClient(self, transport_policy=QBTransportPolicy(**policy))
+        qb.getCustomers()
+        return qb
+
+    def requests(self, fn, *args):
+        """
+        Call fn and return the number of requests the simulator received meanwhile.
+        """
+        before = self.sim.stats['requests']
+        fn(*args)
+        return self.sim.stats['requests'] - before
+
+    def testQueriesRetried(self):
+        qb = self.makeClient()
+        self.sim.inject(500, "drop", 502)
+        self.assertEqual(self.requests(qb.getCustomers), 4)
+        self.sim.inject(500, 500)
+        qb.transport_policy.query_retries = 1
+        self.assertRaises(QBOEHTTPError, qb.getCustomers)
+        # Client errors aren't worth retrying.
+        self.sim.inject(400)
+        before = self.sim.stats['requests']
+        self.assertRaises(QBOEHTTPError, qb.getCustomers)
+        self.assertEqual(self.sim.stats['requests'], before + 1)
+
+    def testAddsOnlyRetriedWhenNotProcessed(self):
+        qb = self.makeClient()
+        # A 503 (or 429) means the gateway turned the request away, so it can be sent again...
+        self.sim.inject(503, 503)
+        self.assertEqual(self.requests(qb.putInvoices, [self.makeInvoice("r1")]), 3)
+        self.assertEqual(len(self.company().invoices), 1)
+        # ...but after a 500 or a lost response it may have been processed.
+        self.sim.inject(500)
+        self.assertRaises(QBOEHTTPError, qb.putInvoices, [self.makeInvoice("r2")])
+        self.sim.inject("drop")
+        self.assertRaises(socket.error, qb.putInvoices, [self.makeInvoice("r3")])
+        self.assertEqual(len(self.company().invoices), 2)
+
+    def testCircuitBreaker(self):
+        qb = self.makeClient(query_retries=0, failure_threshold=3, reset_timeout=0.2)
+        breaker = qb.transport_policy.breaker
+        self.sim.inject(500, 500, 500)
+        for i in range(3):
+            self.assertRaises(QBOEHTTPError, qb.getCustomers)
+        self.assertEqual(breaker.state, QBCircuitBreaker.OPEN)
+        # While it is open, requests fail without being sent.
+        before = self.sim.stats['requests']
+        self.assertRaises(QBOECircuitOpenError, qb.getCustomers)
+        self.assertEqual(self.sim.stats['requests'], before)
+
+        # After reset_timeout one trial request is let through; if it fails the breaker opens again.
+        time.sleep(0.25)
+        self.sim.inject(500)
+        self.assertRaises(QBOEHTTPError, qb.getCustomers)
+        self.assertEqual(breaker.state, QBCircuitBreaker.OPEN)
+        self.assertRaises(QBOECircuitOpenError, qb.getCustomers)
+        time.sleep(0.25)
+        self.assertEqual(self.requests(qb.getCustomers), 1)
+        self.assertEqual((breaker.state, breaker.failures), (QBCircuitBreaker.CLOSED, 0))
+
+    def testRateLimit(self):
+        qb = self.makeClient(rate=20, burst=1)
+        start = time.time()
+        for i in range(10):
+            qb.getCustomers()
+        self.assertTrue(time.time() - start >= 9 / 20.0 - 0.01)
+
+    def testThrottleBacksOff(self):
+        bucket = QBTokenBucket(100, min_rate=10)
+        for expected in (50, 25, 12.5, 10, 10):
+            bucket.throttle()
+            self.assertEqual(bucket.rate, expected)
+        bucket.recover()
+        self.assertEqual(bucket.rate, 15)
+        qb = self.makeClient(rate=100)
+        self.sim.inject(503)
+        qb.getCustomers()
+        self.assertEqual(qb.transport_policy.limiter.rate, 50 + 5)
+
+class AsyncTest(SimTestCase):
+    sim_options = dict(customers=3, latency=0.05)
+
+    def testCallsDontBlock(self):
+        aqb = self.makeClient(cls=AsyncQBOE, workers=2, max_in_flight=2)
+        start = time.time()
+        futures = [aqb.getCustomers() for i in range(6)]
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertEqual([len(f.result()) for f in futures], [3] * 6)
+        self.assertEqual(len(aqb.syncCustomers().result()), 3)
+        aqb.addInvoice(self.makeInvoice("r1"))
+        self.assertEqual(aqb.putInvoices().result().keys(), ["r1"])
+
+    def testOnlyAsyncCalls(self):
+        aqb = self.makeClient(cls=AsyncQBOE)
+        for name in ("iterInvoices", "streamCustomers", "putInvoiceStream", "reconcileQueue", "invoices"):
+            self.assertFalse(hasattr(aqb, name), name)
+        batch = aqb.batch()
+        customers = batch.getCustomers()
+        aqb.sendBatch(batch).result()
+        self.assertEqual(len(customers.result()), 3)
+
+class SyncTest(SimTestCase):
+    sim_options = dict(customers=3, invoices=2)
+
+    def testIncremental(self):
+        qb = self.makeClient()
+        self.assertEqual(len(qb.syncCustomers()), 3)
+        self.assertEqual(len(qb.syncInvoices()), 2)
+        cursor = qb.sync_store.load("invoices")[0]
+
+        # An invoice changed without its TimeModified moving past the cursor isn't fetched again.
+        invoices = self.company().invoices
+        invoices[0] = (SIM_EPOCH, invoices[0][1].replace("<IsPaid>", "<Memo>edited</Memo><IsPaid>"))
+        time.sleep(1)
+        qb.putInvoices([self.makeInvoice("r1")])
+        snapshot = qb.syncInvoices()
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot["1-3000000000"].memo, None)
+        self.assertTrue(qb.sync_store.load("invoices")[0] > cursor)
+
+        qb.resetSync("invoices")
+        self.assertEqual(qb.syncInvoices()["1-3000000000"].memo, "edited")
+
+    def testStores(self):
+        qb = self.makeClient()
+        self.assertEqual(type(qb.sync_store), QBSyncStore)
+        path = tempfile.mkdtemp(prefix="qbtest")
+        self.addCleanup(shutil.rmtree, path)
+        qb = self.makeClient(sync_store=path)
+        qb.syncInvoices()
+        other = self.makeClient(sync_store=path)
+        cursor, snapshot = other.sync_store.load("invoices")
+        self.assertEqual(sorted(snapshot), ["1-3000000000", "2-3000000000"])
+
+class StreamTest(SimTestCase):
+    sim_options = dict(customers=200, invoices=3)
+
+    def testStreamsMatchLists(self):
+        qb = self.makeClient()
+        self.assertEqual([c.list_id for c in qb.streamCustomers()], [c.list_id for c in qb.getCustomers()])
+        self.assertEqual([c.name for c in qb.streamCustomers(max_returned=2)], ["Customer 0", "Customer 1"])
+        invoices = list(qb.streamInvoices(customer_ids=["1-1000000000"]))
+        self.assertEqual([(i.txn_id, len(i.line_items)) for i in invoices], [("2-3000000000", 1)])
+
+    def testNothingSentUntilRead(self):
+        metrics = QBMetrics()
+        qb = self.makeClient(metrics=metrics)
+        qb.getCustomers()
+        before = self.sim.stats['requests']
+        stream = qb.streamCustomers()
+        del stream
+        self.assertEqual(self.sim.stats['requests'], before)
+        self.assertEqual(metrics.requests[("CustomerQueryRq", "query")], 1)
+
+    def testClosedEarly(self):
+        metrics = QBMetrics()
+        qb = self.makeClient(metrics=metrics, pool_size=1)
+        for i in range(3):
+            stream = qb.streamCustomers()
+            self.assertEqual(next(stream).name, "Customer 0")
+            stream.close()
+        self.assertEqual(metrics.requests[("CustomerQueryRq", "query")], 3)
+        self.assertEqual(len(qb.getCustomers()), 200)
+
+class MetricsTest(SimTestCase):
+    sim_options = dict(customers=30, invoices=2)
+
+    def testCounters(self):
+        metrics = QBPrometheusMetrics()
+        qb = self.makeClient(metrics=metrics)
+        qb.getCustomers()
+        list(qb.iterCustomers(page_size=10))
+        qb.getInvoices()
+        qb.refreshItems(force=True)
+        batch = qb.batch()
+        batch.getCustomers()
+        batch.send()
+        qb.putInvoices([self.makeInvoice("r1"), self.makeInvoice("r2")])
+        self.sim.inject(400)
+        self.assertRaises(QBOEHTTPError, qb.getCustomers)
+
+        summary = metrics.summary()
+        self.assertEqual(summary['requests'], {("SignonAppCertRq", "signon"): 1, ("CustomerQueryRq", "query"): 5
+                                                ,("InvoiceQueryRq", "query"): 1, ("ItemQueryRq", "query"): 1
+                                                ,("Batch", "query"): 1, ("InvoiceAddRq", "add"): 1})
+        self.assertEqual(summary['signons'], 1)
+        self.assertEqual(summary['errors'], {"QBOEHTTPError": 1})
+        # The sign-on, six streamed queries, the batch and two adds; the batch and add responses are parsed
+        # whole, so their SignonTicketRs statuses are counted too.
+        self.assertEqual(summary['statuses'], {"0": 1 + 6 + 1 + 2 + 2})
+        self.assertEqual(summary['messages'], 5 + 1 + 1 + 1 + 2)
+        self.assertEqual(summary['phases'][("add", "elapsed")][0], 1)
+        self.assertTrue(summary['bytes_sent'] > 0 and summary['bytes_received'] > 0)
+        self.assertTrue('qbxml_requests_total{request="CustomerQueryRq",kind="query"} 5' in metrics.render())
+
+class ConnectionPoolTest(SimTestCase):
+    sim_options = dict(customers=3)
+
+    def testKeepAlive(self):
+        qb = self.makeClient()
+        connections = self.sim.stats['connections']
+        for i in range(5):
+            self.assertEqual(len(qb.getCustomers()), 3)
+        qb.putInvoices([self.makeInvoice("r1")])
+        self.assertEqual(self.sim.stats['connections'], connections + 1)
+        self.assertEqual((qb.pool.handshakes, qb.pool.reuses), (1, 6))
+
+    def testClosedConnectionDiscarded(self):
+        qb = self.makeClient()
+        qb.getCustomers()
+        self.sim.inject("close")
+        qb.getCustomers()
+        time.sleep(0.05)
+        # The health check notices that the gateway closed the idle connection, so even an add goes
+        # out on a new one.
+        qb.putInvoices([self.makeInvoice("r1")])
+        self.assertEqual((qb.pool.handshakes, qb.pool.discards), (2, 1))
+        self.assertEqual(len(self.company().invoices), 1)
+
+    def testStaleConnection(self):
+        qb = self.makeClient(pool_health_check=False, transport_policy=QBTransportPolicy(query_retries=0, add_retries=0))
+        qb.getCustomers()
+        self.sim.inject("close")
+        qb.getCustomers()
+        time.sleep(0.05)
+        # A query that fails on a reused connection is sent again on a new one, without counting as a retry...
+        self.assertEqual(len(qb.getCustomers()), 3)
+        self.assertEqual(qb.pool.handshakes, 2)
+
+        self.sim.inject("close")
+        qb.getCustomers()
+        time.sleep(0.05)
+        # ...but an add isn't, since the gateway might have received it.
+        self.assertRaises((httplib.HTTPException, socket.error), qb.putInvoices, [self.makeInvoice("r1")])
+        self.assertEqual(qb.pool.handshakes, 2)
+
+class IteratorTest(SimTestCase):
+    sim_options = dict(customers=20, invoices=20)
+
+    def testPages(self):
+        qb = self.makeClient()
+        qb.getCustomers()
+        before = self.sim.stats['requests']
+        customers = qb.iterCustomers(page_size=7)
+        self.assertEqual(next(customers).name, "Customer 0")
+        # Later pages are only requested as the records are consumed.
+        self.assertEqual(self.sim.stats['requests'], before + 1)
+        self.assertEqual(len(list(customers)), 19)
+        self.assertEqual(self.sim.stats['requests'], before + 3)
+
+    def testPrefetch(self):
+        qb = self.makeClient()
+        self.assertEqual([c.list_id for c in qb.iterCustomers(page_size=6, prefetch=True)]
+                        ,[c.list_id for c in qb.getCustomers()])
+        self.assertEqual(len(list(qb.iterCustomers(page_size=20))), 20)
+
+    def testFilteredPages(self):
+        qb = self.makeClient(page_size=2)
+        invoices = list(qb.iterInvoices(customer_ids=["1-1000000000", "2-1000000000", "3-1000000000"]))
+        self.assertEqual([i.txn_id for i in invoices], ["%d-3000000000" % n for n in (2, 3, 4)])
+        self.assertEqual([len(i.line_items) for i in invoices], [1, 1, 1])
+        self.assertEqual(list(qb.iterCustomers(active_status="InactiveOnly")), [])
+
+    def testIDFiltersCantBePaged(self):
+        qb = self.makeClient()
+        self.assertRaises(QBOEError, list, qb.iterCustomers(list_ids=["1-1000000000"]))
+
+class SessionTicketTest(SimTestCase):
+    sim_options = dict(customers=3)
+
+    def testExpiredTicketReplayed(self):
+        qb = self.makeClient()
+        qb.getCustomers()
+        signons = self.sim.stats['signons']
+        self.sim.tickets.clear()
+        self.assertEqual(len(qb.getCustomers()), 3)
+        self.sim.tickets.clear()
+        qb.putInvoices([self.makeInvoice("r1")])
+        self.sim.tickets.clear()
+        self.assertEqual(len(list(qb.iterCustomers(page_size=2))), 3)
+        self.assertEqual(self.sim.stats['signons'], signons + 3)
+        self.assertEqual(len(self.company().invoices), 1)
+
+    def testProactiveRefresh(self):
+        qb = self.makeClient(ticket_lifetime=1.0, ticket_refresh_margin=0.5)
+        qb.getCustomers()
+        time.sleep(0.6)
+        before = self.sim.stats['requests']
+        qb.getCustomers()
+        # A new ticket is obtained before the old one expires, so no request is rejected.
+        self.assertEqual(self.sim.stats['requests'], before + 2)
+        self.assertTrue(qb.sessionTicketAge() < 0.5)
+
+    def testSharedFileCache(self):
+        path = tempfile.mkdtemp(prefix="qbtest")
+        self.addCleanup(shutil.rmtree, path)
+        cache = os.path.join(path, "tickets.json")
+        signons = self.sim.stats['signons']
+        # Separate cache objects, as two processes would have.
+        for i in range(3):
+            self.makeClient(ticket_cache=QBFileTicketCache(cache)).getCustomers()
+        self.assertEqual(self.sim.stats['signons'], signons + 1)
+        self.makeClient(ticket_cache=QBFileTicketCache(cache), conn_ticket=self.id() + "-other").getCustomers()
+        self.assertEqual(self.sim.stats['signons'], signons + 2)
+
+class ItemCatalogTest(SimTestCase):
+    sim_options = dict(customers=3, items=("Sled", "Toboggan"))
+
+    def makeInvoice(self, request_id, *items):
+        invoice = QBInvoice(invoice_date=datetime.date(2010, 1, 15), customer_id="0-1000000000", request_id=request_id
+                            ,auto_create_items=True)
+        for item in items:
+            invoice.addLineItem(qty=Decimal("1"), fullname=item, description="Line 1", rate=Decimal("10.00")
+                                ,item_type=QBItemType.SERVICE, account="Sales")
+        return invoice
+
+    def testMissing(self):
+        catalog = QBItemCatalog()
+        catalog.add("Sled", "1-2000000000")
+        self.assertTrue("SLED" in catalog)
+        self.assertFalse(None in catalog)
+        invoice = self.makeInvoice("r1", "sled", "Widget", "WIDGET", "Gadget", "widget")
+        self.assertEqual([li.fullname for li in catalog.missing(invoice.line_items)], ["Widget", "Gadget"])
+
+    def testRefresh(self):
+        qb = self.makeClient(item_refresh_interval=60)
+        self.assertEqual(len(qb.refreshItems()), 2)
+        self.assertTrue("toboggan" in qb.items)
+
+        requests = self.sim.stats['requests']
+        self.company().addItem("Gadget")
+        qb.refreshItems()
+        self.assertEqual(self.sim.stats['requests'], requests)
+        self.assertFalse("Gadget" in qb.items)
+        qb.refreshItems(force=True)
+        self.assertTrue("gadget" in qb.items)
+
+        # Only items modified since the newest one seen are requested, so a backdated one is missed.
+        self.company().addItem("Backdated", SIM_EPOCH)
+        self.company().addItem("Widget")
+        qb.refreshItems(force=True)
+        self.assertTrue("WIDGET" in qb.items)
+        self.assertFalse("Backdated" in qb.items)
+        self.assertEqual(len(qb.items), 4)
+
+    def testAutoCreate(self):
+        qb = self.makeClient()
+        messages = self.sim.stats['messages']
+        refs = qb.putInvoices([self.makeInvoice("r1", "SLED", "Widget"), self.makeInvoice("r2", "widget", "Gadget")])
+        self.assertEqual(sorted(refs), ["r1", "r2"])
+        self.assertEqual(sorted(self.company().items), ["gadget", "sled", "toboggan", "widget"])
+        # One ItemQueryRq, one ItemServiceAddRq per new item and one InvoiceAddRq per invoice: none is
+        # rejected with status 3140 and resubmitted.
+        self.assertEqual(self.sim.stats['messages'], messages + 5)
+        self.assertTrue("GADGET" in qb.items)
+
+class RecordListTest(SimTestCase):
+    sim_options = dict(customers=5)
+
+    def testCustomerLookups(self):
+        customers = self.makeClient().getCustomers()
+        customer = customers.getByListID("2-1000000000")
+        self.assertTrue(customers.getByName(customer.name) is customer)
+        self.assertTrue(customers.getByFullName(customer.full_name) is customer)
+
+        customers.remove(customer)
+        self.assertEqual(len(customers), 4)
+        for lookup, key in ((customers.getByListID, customer.list_id), (customers.getByName, customer.name)
+                            ,(customers.getByFullName, customer.full_name)):
+            self.assertRaises(QBOELookupError, lookup, key)
+        self.assertRaises(KeyError, customers.getByListID, customer.list_id)
+        self.assertEqual(customers.getByListID("3-1000000000").list_id, "3-1000000000")
+
+        # Records added after the indexes are built are found too.
+        customers.add(customer)
+        self.assertTrue(customers.getByName(customer.name) is customer)
+
+    def testDuplicateKeys(self):
+        first, second = self.makeInvoice("r1", memo="first"), self.makeInvoice("r1", memo="second")
+        invoices = QBInvoices([first, second, self.makeInvoice("r2")])
+        self.assertTrue(invoices.getByRequestID("r1") is first)
+        invoices.remove(first)
+        self.assertTrue(invoices.getByRequestID("r1") is second)
+        invoices.remove(second)
+        self.assertRaises(QBOELookupError, invoices.getByRequestID, "r1")
+        self.assertEqual(invoices.getByRequestID("r2").request_id, "r2")
+        self.assertEqual(len(invoices.invoices), 1)
+
+def slotState(value):
+    """
+    Return a record's slots (and those of the records it holds) as plain values that can be compared.
+    """
+    if isinstance(value, (pyQBXML.QBRecordList, list, tuple)):
+        return [slotState(record) for record in value]
+    if type(value).__module__ == 'pyQBXML' and hasattr(type(value), '__slots__'):
+        return dict((attr, slotState(v)) for attr, v in pyQBXML._getSlotState(value).iteritems())
+    return value
+
+class PickleTest(SimTestCase):
+    sim_options = dict(customers=3, invoices=3)
+
+    def roundTrips(self, value):
+        for module in (pickle, cPickle):
+            for protocol in (0, 1, 2):
+                yield module.loads(module.dumps(value, protocol))
+
+    def testRecords(self):
+        qb = self.makeClient()
+        customers = qb.getCustomers()
+        customers.getByListID("1-1000000000")
+        customers.getByListID("2-1000000000").bill_address = pyQBXML.EMPTY_ADDRESS
+        invoices = qb.getInvoices()
+        self.assertEqual(len(invoices.getByRequestID(invoices.invoices[0].request_id).line_items.line_items), 1)
+        for records in (customers, invoices):
+            for copy in self.roundTrips(records):
+                self.assertEqual(type(copy), type(records))
+                self.assertEqual(slotState(copy), slotState(records))
+                self.assertTrue(copy.records is getattr(copy, records.record_name + "s"))
+        for copy in self.roundTrips(customers):
+            self.assertTrue(copy.getByListID("2-1000000000").bill_address is pyQBXML.EMPTY_ADDRESS)
+            self.assertEqual(copy.getByListID("1-1000000000").bill_address.city, "Springfield")
+
+    def testResults(self):
+        invoice = self.makeInvoice("r1")
+        results = QBResults([pyQBXML.QBResult("r1", 0, "Info", None, "1001", "1-3000000000", invoice)
+                            ,pyQBXML.QBResult("r2", 3175, "Error", "In use")])
+        for copy in self.roundTrips(results):
+            self.assertEqual(slotState(copy), slotState(results))
+            self.assertEqual(copy.getByRequestID("r1").invoice.line_items.line_items[0].rate, Decimal("10.00"))
+            self.assertEqual([r.request_id for r in copy.transient()], ["r2"])
+
+    def testReconciliation(self):
+        local = [self.makeInvoice("r1", memo="one"), self.makeInvoice("r2", memo="two")]
+        recon = self.makeClient().reconcileInvoices(local)
+        for copy in self.roundTrips(recon):
+            self.assertEqual(slotState(copy), slotState(recon))
+            self.assertEqual(repr(copy), repr(recon))
+
+    def testUnsetSlots(self):
+        invoice = QBInvoice.__new__(QBInvoice)
+        invoice.memo = "partial"
+        for copy in self.roundTrips(invoice):
+            self.assertEqual(copy.memo, "partial")
+            self.assertRaises(AttributeError, getattr, copy, "customer_id")
+
+    def testOldPickles(self):
+        # Protocol 2 pickles made before the record classes defined __getstate__ hold a (None, slots) pair.
+        invoice = QBInvoice.__new__(QBInvoice)
+        invoice.__setstate__((None, {'memo': "old", 'request_id': "r1"}))
+        self.assertEqual((invoice.memo, invoice.request_id), ("old", "r1"))
+
+class SubmitResultsTest(SimTestCase):
+    sim_options = dict(customers=4)
+
+    def testRetryPartitioning(self):
+        qb = self.makeClient()
+        qb.getCustomers()
+        self.company().locked["1-1000000000"] = 2
+        messages = self.sim.stats['messages']
+        invoices = [self.makeInvoice("r1"), self.makeInvoice("r2", customer=1), self.makeInvoice("r3", item="Nope")
+                    ,self.makeInvoice("r4", customer=2)]
+        results = qb.submitInvoices(invoices, backoff=0.01)
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(sorted(results.refNumbers()), ["r1", "r2", "r4"])
+        self.assertEqual([r.request_id for r in results.permanent()], ["r3"])
+        self.assertEqual(results.getByRequestID("r3").status_code, 3140)
+        self.assertEqual(results.transient(), [])
+        self.assertTrue(results.getByRequestID("r2").invoice is invoices[1])
+        # Only the locked customer's invoice is resubmitted, once for each time it was refused.
+        self.assertEqual(self.sim.stats['messages'], messages + 6)
+        self.assertEqual(len(self.company().invoices), 3)
+
+    def testRetriesExhausted(self):
+        qb = self.makeClient()
+        self.company().locked["1-1000000000"] = 5
+        results = qb.submitInvoices([self.makeInvoice("r1"), self.makeInvoice("r2", customer=1)], retries=2, backoff=0.01)
+        self.assertEqual([r.request_id for r in results.failed()], ["r2"])
+        self.assertEqual([r.request_id for r in results.transient()], ["r2"])
+        self.assertEqual(results.permanent(), [])
+        self.assertEqual(self.company().locked["1-1000000000"], 2)
+
+        # A transient failure isn't retried by putInvoices().
+        self.company().locked["1-1000000000"] = 1
+        try:
+            qb.putInvoices([self.makeInvoice("r3", customer=1)])
+            self.fail("Expected QBXMLError")
+        except QBXMLError, e:
+            self.assertEqual(e.err_code, 3175)
+        self.assertEqual(len(self.company().invoices), 1)
+
+class QueryFilterTest(SimTestCase):
+    sim_options = dict(customers=5, invoices=6)
+
+    def testIDFilters(self):
+        qb = self.makeClient()
+        customers = qb.getCustomers(list_ids=["1-1000000000", "3-1000000000"])
+        self.assertEqual(sorted(c.list_id for c in customers), ["1-1000000000", "3-1000000000"])
+        self.assertEqual(qb.getCustomers(full_names="Customer 4").customers[0].list_id, "4-1000000000")
+        # IncludeLineItems may go with an ID filter.
+        invoices = qb.getInvoices(txn_ids=["2-3000000000"])
+        self.assertEqual(len(invoices), 1)
+        self.assertEqual(len(invoices.invoices[0].line_items.line_items), 1)
+        self.assertEqual([i.txn_id for i in qb.getInvoices(ref_numbers=["1005"])], ["5-3000000000"])
+
+    def testMixedFiltersRejected(self):
+        qb = self.makeClient()
+        requests = self.sim.stats['requests']
+        for call, criteria in ((qb.getCustomers, dict(list_ids=["1-1000000000"], active_status="ActiveOnly"))
+                                ,(qb.getCustomers, dict(list_ids=["1-1000000000"], full_names=["Customer 1"]))
+                                ,(qb.getCustomers, dict(full_names=["Customer 1"], from_modified=datetime.datetime(2010, 1, 1)))
+                                ,(qb.getInvoices, dict(txn_ids=["1-3000000000"], paid_status="NotPaidOnly"))
+                                ,(qb.getInvoices, dict(ref_numbers=["1001"], customer_ids=["1-1000000000"]))
+                                ,(qb.getInvoices, dict(txn_ids=["1-3000000000"], from_date=datetime.date(2010, 1, 1)))
+                                ,(qb.streamInvoices, dict(txn_ids=["1-3000000000"], max_returned=5))):
+            self.assertRaises(QBOEError, call, **criteria)
+        self.assertEqual(self.sim.stats['requests'], requests)
+
+    def testProjection(self):
+        qb = self.makeClient()
+        customer = qb.getCustomers(list_ids=["2-1000000000"], fields=["Email"]).customers[0]
+        self.assertEqual((customer.list_id, customer.name, customer.email)
+                        ,("2-1000000000", "Customer 2", "customer2@example.com"))
+        self.assertEqual(customer.phone, None)
+
+        invoices = qb.getInvoices(fields=["RefNumber"])
+        self.assertEqual(len(invoices), 6)
+        invoice = invoices.invoices[0]
+        self.assertEqual((invoice.txn_id, invoice.ref_number, invoice.customer_id)
+                        ,("1-3000000000", "1001", "0-1000000000"))
+        self.assertEqual(invoice.memo, None)
+        self.assertEqual(len(invoice.line_items), 0)
+        invoice = qb.getInvoices(fields=["InvoiceLineRet"], customer_ids=["1-1000000000"]).invoices[0]
+        self.assertEqual(invoice.line_items.line_items[0].fullname, "Sled")
+
+class RecordCacheTest(SimTestCase):
+    sim_options = dict(customers=5, invoices=2)
+
+    def requests(self, call, *args):
+        before = self.sim.stats['requests']
+        result = call(*args)
+        return result, self.sim.stats['requests'] - before
+
+    def testReadThrough(self):
+        qb = self.makeClient()
+        qb.getCustomers()
+        found, requests = self.requests(qb.getCustomersByListID, ["1-1000000000", "2-1000000000"])
+        self.assertEqual((sorted(found), requests), (["1-1000000000", "2-1000000000"], 1))
+        customer, requests = self.requests(qb.getCustomer, "1-1000000000")
+        self.assertEqual((customer.name, requests), ("Customer 1", 0))
+        found, requests = self.requests(qb.getCustomersByListID, ["1-1000000000", "3-1000000000", "9-1000000000"])
+        self.assertEqual((sorted(found), requests), (["1-1000000000", "3-1000000000"], 1))
+        self.assertRaises(QBOELookupError, qb.getCustomer, "9-1000000000")
+        self.assertEqual(qb.customer_cache.stats()['hits'], 2)
+        self.assertEqual(len(qb.customer_cache), 3)
+
+        invoice, requests = self.requests(qb.getInvoice, "1002")
+        self.assertEqual((invoice.txn_id, requests), ("2-3000000000", 1))
+        self.assertTrue(self.requests(qb.getInvoice, "1002")[0] is invoice)
+
+    def testInvalidatedByPutInvoices(self):
+        qb = self.makeClient()
+        qb.getCustomersByListID(["0-1000000000", "1-1000000000", "2-1000000000"])
+        qb.putInvoices([self.makeInvoice("r1", customer=0), self.makeInvoice("r2", customer=2)])
+        self.assertEqual(len(qb.customer_cache), 1)
+        self.assertEqual(self.requests(qb.getCustomer, "1-1000000000")[1], 0)
+        self.assertEqual(self.requests(qb.getCustomer, "0-1000000000")[1], 1)
+
+        # Streamed invoices aren't kept, so every customer is dropped.
+        qb.putInvoiceStream([self.makeInvoice("r3", customer=4)])
+        self.assertEqual(len(qb.customer_cache), 0)
+
+        qb.getCustomersByListID(["0-1000000000", "1-1000000000"])
+        qb.invalidateCache(customers="1-1000000000")
+        self.assertEqual(len(qb.customer_cache), 1)
+        qb.invalidateCache()
+        self.assertEqual(len(qb.customer_cache), 0)
+
+    def testExpiryAndEviction(self):
+        qb = self.makeClient(customer_cache=QBRecordCache(ttl=0.1, max_size=2))
+        qb.getCustomersByListID(["0-1000000000", "1-1000000000", "2-1000000000"])
+        self.assertEqual(qb.customer_cache.stats()['evicted'], 1)
+        self.assertEqual(self.requests(qb.getCustomer, "2-1000000000")[1], 0)
+        time.sleep(0.15)
+        self.assertEqual(self.requests(qb.getCustomer, "2-1000000000")[1], 1)
+        self.assertEqual(qb.customer_cache.stats()['expired'], 1)
+
+        qb = self.makeClient(customer_cache=QBRecordCache(ttl=0))
+        qb.getCustomer("0-1000000000")
+        self.assertEqual(self.requests(qb.getCustomer, "0-1000000000")[1], 1)
+
+class CompanyManagerTest(SimTestCase):
+    sim_options = dict(customers=3, invoices=3)
+
+    def makeManager(self, **kwargs):
+        manager = QBCompanyManager(self.sim.api_url, self.sim.keyfile, self.sim.certfile, "qbsim", "1", "1"
+                                    ,ssl_context=self.sim.clientContext(), **kwargs)
+        self.addCleanup(manager.close)
+        return manager
+
+    def testWeightedFairness(self):
+        manager = self.makeManager(workers=1, max_concurrency=None)
+        for name, weight in (("gate", 1), ("heavy", 2), ("light", 1)):
+            manager.addCompany(name, self.id() + name, weight=weight)
+        # Hold the only worker until both companies have work queued.
+        opened = threading.Event()
+        manager.submit("gate", lambda client: opened.wait())
+        order = []
+        futures = [manager.submit(name, lambda client, name=name: order.append(name))
+                    for i in range(6) for name in ("light", "heavy")]
+        opened.set()
+        for future in futures:
+            future.result()
+        self.assertEqual(sorted(order[:6]), ["heavy"] * 4 + ["light"] * 2)
+        self.assertEqual(manager.stats()["heavy"], {'queued': 0, 'in_flight': 0, 'submitted': 6, 'completed': 6
+                                                    ,'failed': 0})
+
+    def testMaxConcurrency(self):
+        manager = self.makeManager(workers=4, max_concurrency=1)
+        manager.addCompany("slow", self.id() + "slow")
+        manager.addCompany("fast", self.id() + "fast", max_concurrency=3)
+        lock = threading.Lock()
+        running = dict(slow=[0, 0], fast=[0, 0])
+
+        def job(client, name):
+            with lock:
+                running[name][0] += 1
+                running[name][1] = max(running[name])
+            time.sleep(0.05)
+            with lock:
+                running[name][0] -= 1
+        futures = [manager.submit(name, job, name) for i in range(4) for name in ("slow", "fast")]
+        for future in futures:
+            future.result()
+        self.assertEqual((running["slow"][1], running["fast"][1]), (1, 3))
+
+    def testCompanies(self):
+        manager = self.makeManager()
+        clients = [manager.addCompany(name, self.id() + name) for name in ("a", "b")]
+        self.assertRaises(QBOEError, manager.addCompany, "a", self.id() + "a")
+        self.assertTrue(clients[0].sync_store is not clients[1].sync_store)
+        self.assertTrue(isinstance(clients[0].sync_store, QBSyncStore))
+        self.assertTrue(clients[0].pool is clients[1].pool)
+
+        manager.submit("a", "putInvoices", [self.makeInvoice("r1")]).result()
+        synced = manager.map("syncInvoices")
+        self.assertEqual(dict((name, len(f.result())) for name, f in synced.iteritems()), {"a": 4, "b": 3})
+        self.assertRaises(QBOELookupError, manager.submit, "c", "getCustomers")
+        manager.removeCompany("b")
+        self.assertEqual(manager.map("getCustomers").keys(), ["a"])
+        self.assertRaises(QBOEError, self.makeManager, sync_store=QBSyncStore())
+
+class LazyRecordTest(SimTestCase):
+    sim_options = dict(customers=3, invoices=3)
+
+    def testCustomers(self):
+        eager = self.makeClient().getCustomers()
+        lazy = self.makeClient(lazy_records=True).getCustomers()
+        customer = lazy.getByListID("1-1000000000")
+        self.assertTrue(isinstance(customer, pyQBXML.QBLazyCustomer))
+        # Looking it up by ListID indexed the customers by full_name too, which decoded it.
+        self.assertEqual(customer._pending, len(customer.decoders) - 1)
+        self.assertEqual(customer.bill_address.city, "Springfield")
+        self.assertEqual(customer._pending, len(customer.decoders) - 2)
+        self.assertEqual(customer.balance, Decimal("1.50"))
+        state = slotState(customer.materialize())
+        self.assertEqual((state.pop('_raw'), state.pop('_pending')), (None, 0))
+        self.assertEqual(state, slotState(eager.getByListID("1-1000000000")))
+
+        for copy in pickle.loads(pickle.dumps(lazy, 0)), cPickle.loads(cPickle.dumps(lazy, 2)):
+            self.assertEqual([type(c) for c in copy], [pyQBXML.QBCustomer] * 3)
+            self.assertEqual(slotState(copy), slotState(eager))
+
+    def testInvoices(self):
+        eager = self.makeClient().getInvoices()
+        lazy = self.makeClient(lazy_records=True).getInvoices()
+        invoice = lazy.invoices[1]
+        self.assertEqual(invoice.customer_id, "1-1000000000")
+        self.assertEqual(invoice.line_items.line_items[0].rate, Decimal("800.00"))
+        self.assertEqual((invoice.txn_id, invoice.invoice_date), ("2-3000000000", datetime.date(2010, 1, 15)))
+        self.assertTrue(invoice._raw is not None)
+
+        # Pickling decodes whatever hasn't been read, and the copies are plain invoices.
+        for copy in pickle.loads(pickle.dumps(lazy, 1)), cPickle.loads(cPickle.dumps(lazy, 2)):
+            self.assertEqual([type(i) for i in copy], [QBInvoice] * 3)
+            for mine, theirs in zip(copy, eager):
+                state, expected = slotState(mine), slotState(theirs)
+                for attr in ('request_id', 'due_date'):
+                    del state[attr], expected[attr]
+                self.assertEqual(state, expected)
+        self.assertTrue(all(i._raw is None for i in lazy))
+
+    def testProjection(self):
+        qb = self.makeClient(lazy_records=True)
+        customer = qb.getCustomers(fields=["Phone"]).customers[0]
+        self.assertEqual((customer.name, customer.phone, customer.email), ("Customer 0", "555-0100", None))
+        invoice = qb.getInvoices(fields=["RefNumber"]).invoices[2]
+        self.assertEqual((invoice.ref_number, invoice.memo, len(invoice.line_items)), ("1003", None, 0))
+
+class ExportTest(SimTestCase):
+    sim_options = dict(customers=3, invoices=6, items=("Sled", "Toboggan"))
+
+    def expectedTotals(self, invoices, key):
+        totals = {}
+        for invoice in invoices:
+            for li in invoice.line_items:
+                k = key(invoice, li)
+                totals[k] = totals.get(k, 0) + li.qty * li.rate
+        return totals
+
+    def testInvoiceTotals(self):
+        qb = self.makeClient()
+        invoice = QBInvoice(invoice_date=datetime.date(2010, 2, 1), customer_id="1-1000000000", request_id="r1")
+        invoice.addLineItem(qty=Decimal("1.5"), fullname="Sled", description="Half", rate=Decimal("10.01"))
+        invoice.addLineItem(qty=Decimal("3"), fullname="Toboggan", description="Thirds", rate=Decimal("0.33"))
+        qb.putInvoices([invoice])
+
+        export = qb.exportInvoices(page_size=4)
+        self.assertEqual((len(export.invoices), len(export.lines)), (7, 8))
+        invoices = qb.getInvoices()
+        for totals, key in ((export.totalsByCustomer(), lambda i, li: i.customer_id)
+                            ,(export.totalsByItem(), lambda i, li: li.fullname)):
+            self.assertEqual(dict((k, Decimal(qbxmlFixedText(v))) for k, v in totals.iteritems())
+                            ,self.expectedTotals(invoices, key))
+        self.assertEqual(qbxmlFixedText(export.totalsByCustomer()["1-1000000000"]), "3216.005")
+
+        export = qb.exportInvoices(customer_ids=["1-1000000000"], from_date=datetime.date(2010, 2, 1))
+        self.assertEqual(list(export.invoices["ref_number"]), ["1007"])
+        self.assertEqual(export.totalsByItem(), {"Sled": qbxmlFixed("15.015"), "Toboggan": qbxmlFixed("0.99")})
+
+        lines = StringIO.StringIO()
+        export.writeCSV(StringIO.StringIO(), lines)
+        self.assertEqual(lines.getvalue().splitlines()
+                        ,["txn_id,customer_id,item,description,qty,rate,amount"
+                          ,"7-3000000000,1-1000000000,Sled,Half,1.50,10.01,15.015"
+                          ,"7-3000000000,1-1000000000,Toboggan,Thirds,3.00,0.33,0.99"])
+
+    def testCustomers(self):
+        export = self.makeClient().exportCustomers(page_size=2)
+        self.assertEqual(list(export["list_id"]), ["0-1000000000", "1-1000000000", "2-1000000000"])
+        self.assertEqual([qbxmlFixedText(b) for b in export["balance"]], ["0.50", "1.50", "2.50"])
+        self.assertEqual(export.totals("full_name", "total_balance")["Customer 2"], qbxmlFixed("2.50"))
+        self.assertEqual(export.rows().next()[:3], ("0-1000000000", "Customer 0", "Customer 0"))
+
+class BatchTest(SimTestCase):
+    def testAddInvoice(self):
+        batch = self.makeClient().batch()
+        future = batch.addInvoice(self.makeInvoice("r1"))
+        batch.send()
+        self.assertTrue(future.result().ok)
+
+    def testAddInvoiceWithSubmitQueue(self):
+        queue = QBSubmitQueue()
+        qb = self.makeClient(submit_queue=queue)
+        self.assertRaises(QBOEError, qb.batch().addInvoice, self.makeInvoice("r1"))
+        self.assertEqual(queue.entries(), [])
+
+if __name__ == '__main__':
+    unittest.main()